@@ -1,7 +1,635 @@
-from flask import Flask, request, redirect, session, jsonify, render_template
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from urllib.parse import urlencode
+
+import jwt
+import numpy as np
+import orjson
+import requests
+import sqlitecloud
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from flask import Flask, Response, g, request, redirect, jsonify, render_template
+from openai import OpenAI
+from pinecone import Pinecone
+
+load_dotenv()
 
 app = Flask(__name__)
+app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key')
+
+SQLITE_CLOUD_URL = os.getenv('SQLITE_CLOUD_URL')
+EMBEDDING_MODEL = 'text-embedding-3-small'
+
+LINE_CHANNEL_ID = os.getenv('LINE_CHANNEL_ID')
+LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
+LINE_REDIRECT_URI = os.getenv('LINE_REDIRECT_URI')
+LINE_AUTH_URL = 'https://access.line.me/oauth2/v2.1/authorize'
+LINE_TOKEN_URL = 'https://api.line.me/oauth2/v2.1/token'
+LINE_PROFILE_URL = 'https://api.line.me/v2/profile'
+
+# Login is a blocking user-facing path; reuse keep-alive connections to
+# LINE instead of paying a fresh TCP+TLS handshake per call, and bound
+# tail latency with explicit (connect, read) timeouts.
+LINE_SESSION = requests.Session()
+LINE_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=20))
+LINE_TIMEOUT = (3, 5)
+
+client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
+search_index = pc.Index(os.getenv('PINECONE_INDEX', 'school-site'))
+cache_index = pc.Index(os.getenv('PINECONE_CACHE_INDEX', 'search-cache'))
+
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_TTL = 3600  # seconds
+
+# In-process read-through cache for whole result sets: a repeat query
+# within the TTL returns in microseconds without touching OpenAI or
+# Pinecone at all. Swap for Redis when scaling past one process.
+results_cache = TTLCache(maxsize=10000, ttl=300)
+results_cache_lock = threading.RLock()
+
+SEARCH_TOP_K = 7
+# Above this, metadata-bearing queries return more egress bytes than an
+# ID-only probe plus a targeted fetch of just the hits.
+METADATA_INLINE_MAX = 20
+
+
+class ConnectionPool:
+    """Thread-safe pool of pre-opened SQLite Cloud connections.
+
+    Opening a connection pays full TCP+TLS+auth setup, so requests borrow
+    an already-open connection and return it when done instead of
+    reconnecting every time.
+    """
+
+    def __init__(self, url, size=8):
+        self.url = url
+        self._pool = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._pool.put(sqlitecloud.connect(url))
+
+    @contextmanager
+    def acquire(self):
+        conn = self._pool.get()
+        try:
+            conn.execute('SELECT 1')
+        except Exception:
+            conn = sqlitecloud.connect(self.url)
+        try:
+            yield conn
+        except Exception:
+            # The connection may be in an unknown state; replace it.
+            try:
+                conn.close()
+            except Exception:
+                pass
+            conn = sqlitecloud.connect(self.url)
+            raise
+        finally:
+            self._pool.put(conn)
+
+
+pool = ConnectionPool(SQLITE_CLOUD_URL, size=int(os.getenv('SQLITE_POOL_SIZE', '8')))
+
+
+REQUIRED_TABLES = {'user', 'user_pinned', 'linebot_message', 'embedding_cache'}
+
+# The same handful of statements runs on every API call; keeping them as
+# module-level constants interns each string once and gives prepared-
+# statement caching in the driver a stable key.
+SQL = {
+    'embedding_get': 'SELECT vector FROM embedding_cache WHERE hash = ?',
+    'embedding_put': 'INSERT OR REPLACE INTO embedding_cache (hash, vector) VALUES (?, ?)',
+    'save_user': 'INSERT OR REPLACE INTO user (lineid, name) VALUES (?, ?)',
+    'groups': (
+        'SELECT DISTINCT group_id, group_name FROM linebot_message '
+        'WHERE line_id = ? AND group_id IS NOT NULL'
+    ),
+    'messages': (
+        'SELECT category, date, event, notes, location, group_id, group_name '
+        'FROM linebot_message WHERE line_id = ? ORDER BY date'
+    ),
+    'messages_by_group': (
+        'SELECT category, date, event, notes, location, group_id, group_name '
+        'FROM linebot_message WHERE line_id = ? AND group_id = ? ORDER BY date'
+    ),
+    'pin_insert': 'INSERT OR IGNORE INTO user_pinned (lineid, info, url) VALUES (?, ?, ?)',
+    'pin_delete': 'DELETE FROM user_pinned WHERE lineid = ? AND info = ? AND url = ?',
+    'pin_exists': 'SELECT 1 FROM user_pinned WHERE lineid = ? AND info = ? AND url = ? LIMIT 1',
+    'pinned_list': 'SELECT info, url FROM user_pinned WHERE lineid = ?',
+    'pinned_infos': 'SELECT DISTINCT info FROM user_pinned',
+    'pinned_version': 'SELECT MAX(id), COUNT(*) FROM user_pinned WHERE lineid = ?',
+    'messages_version': 'SELECT MAX(id), COUNT(*) FROM linebot_message WHERE line_id = ?',
+}
+
+
+def check_schema():
+    """Readiness probe: DDL lives in migrate.py and runs once per deploy,
+    so workers only verify the schema exists instead of replaying it."""
+    with pool.acquire() as conn:
+        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tables = {row[0] for row in cursor.fetchall()}
+    missing = REQUIRED_TABLES - tables
+    if missing:
+        raise RuntimeError(
+            f"missing tables {sorted(missing)}; run RUN_MIGRATIONS=1 python migrate.py"
+        )
+
+
+check_schema()
+
+
+def normalize_query(text):
+    """Collapse whitespace and lowercase so trivially different spellings share a cache entry."""
+    return ' '.join(text.lower().split())
+
+
+@lru_cache(maxsize=2048)
+def _cached_embedding(normalized_text):
+    key = hashlib.sha256(normalized_text.encode('utf-8')).hexdigest()
+    with pool.acquire() as conn:
+        cursor = conn.execute(SQL['embedding_get'], (key,))
+        row = cursor.fetchone()
+        if row is not None:
+            return array('f', row[0]).tolist()
+
+        response = client.embeddings.create(input=[normalized_text], model=EMBEDDING_MODEL)
+        vector = response.data[0].embedding
+        # stdlib array codec: same float32 wire format as before, without
+        # allocating a numpy array per request just to serialize.
+        conn.execute(SQL['embedding_put'], (key, array('f', vector).tobytes()))
+        conn.commit()
+        return vector
+
+
+def get_embedding(text):
+    """Embed text via OpenAI, served from an in-process LRU backed by a persistent SQLite Cloud tier.
+
+    Returns a plain Python list — the Pinecone client consumes lists
+    directly, so numpy is used only as the persistence codec.
+    """
+    return _cached_embedding(normalize_query(text))
+
+
+def get_embeddings(texts, batch_size=96):
+    """Embed many texts with one API call per batch instead of one per text.
+
+    Used by bulk paths (re-embedding pinned items, re-indexing) where
+    per-text round-trips would serialize badly.
+    """
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        chunk = texts[start:start + batch_size]
+        response = client.embeddings.create(input=chunk, model=EMBEDDING_MODEL)
+        vectors.extend(
+            np.asarray(item.embedding, dtype=np.float32) for item in response.data
+        )
+    return np.stack(vectors)
+
+
+def warm_embedding_cache():
+    """Pre-embed pinned info strings so common first searches skip OpenAI.
+
+    Runs in a background thread at boot: pinned items are the queries users
+    repeat, so paying the embedding cost once here removes the cold-start
+    penalty from the request path.
+    """
+    try:
+        with pool.acquire() as conn:
+            cursor = conn.execute(SQL['pinned_infos'])
+            texts = [normalize_query(row[0]) for row in cursor.fetchall()]
+            missing = []
+            for text in texts:
+                key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+                if conn.execute(SQL['embedding_get'], (key,)).fetchone() is None:
+                    missing.append((key, text))
+            if not missing:
+                return
+            vectors = get_embeddings([text for _, text in missing])
+            for (key, _), vector in zip(missing, vectors):
+                conn.execute(SQL['embedding_put'], (key, vector.tobytes()))
+            conn.commit()
+    except Exception as e:
+        app.logger.warning('embedding cache warmup failed: %s', e)
+
+
+threading.Thread(target=warm_embedding_cache, daemon=True).start()
+
+
+def semantic_cache_lookup(query_vector):
+    """Return cached results for a near-duplicate query, or None.
+
+    Paraphrases ("find cafe" vs "find a cafe") miss the exact-match embedding
+    cache, so cached result sets are also keyed by vector in a small Pinecone
+    index and served when cosine similarity clears the threshold.
+    """
+    cached = cache_index.query(vector=query_vector, top_k=1, include_metadata=True)
+    matches = cached.get('matches') or []
+    if not matches:
+        return None
+    top = matches[0]
+    if top['score'] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    metadata = top.get('metadata', {})
+    if time.time() - metadata.get('ts', 0) > SEMANTIC_CACHE_TTL:
+        return None
+    return json.loads(metadata['results'])
+
+
+def semantic_cache_store(query, query_vector, formatted_results):
+    entry_id = hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+    cache_index.upsert(vectors=[{
+        'id': entry_id,
+        'values': query_vector,
+        'metadata': {'results': json.dumps(formatted_results), 'ts': time.time()},
+    }])
+
+
+async def query_search_index(query_vector, top_k=SEARCH_TOP_K):
+    """Query the main index, returning JSON-ready match dicts.
+
+    Small top_k keeps the single metadata-bearing query; larger top_k
+    probes for IDs and scores first, then pulls metadata for only the
+    returned hits with a fetch, which costs fewer egress bytes than
+    shipping metadata for every candidate inline.
+    """
+    if top_k <= METADATA_INLINE_MAX:
+        results = await asyncio.to_thread(
+            search_index.query,
+            vector=query_vector,
+            top_k=top_k,
+            include_metadata=True,
+        )
+        return results.to_dict()['matches']
+
+    probe = await asyncio.to_thread(
+        search_index.query,
+        vector=query_vector,
+        top_k=top_k,
+        include_metadata=False,
+    )
+    matches = probe.to_dict()['matches']
+    if not matches:
+        return matches
+    fetched = await asyncio.to_thread(
+        search_index.fetch, ids=[match['id'] for match in matches]
+    )
+    vectors = fetched.to_dict().get('vectors', {})
+    for match in matches:
+        match['metadata'] = vectors.get(match['id'], {}).get('metadata', {})
+    return matches
+
+
+def get_access_token(code):
+    response = LINE_SESSION.post(LINE_TOKEN_URL, data={
+        'grant_type': 'authorization_code',
+        'code': code,
+        'redirect_uri': LINE_REDIRECT_URI,
+        'client_id': LINE_CHANNEL_ID,
+        'client_secret': LINE_CHANNEL_SECRET,
+    }, timeout=LINE_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['access_token']
+
+
+def get_user_profile(access_token):
+    response = LINE_SESSION.get(LINE_PROFILE_URL, headers={
+        'Authorization': f'Bearer {access_token}',
+    }, timeout=LINE_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def save_user(line_id, name):
+    with pool.acquire() as conn:
+        conn.execute(SQL['save_user'], (line_id, name))
+        conn.commit()
+
+
+def orjson_response(payload, status=200):
+    """Serialize with orjson — several times faster than stdlib json on the
+    metadata-heavy search payloads, and handles numpy arrays natively."""
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype='application/json',
+    )
+
+
+def table_etag(conn, version_sql_key, line_id, extra=''):
+    """Cheap content version for polled endpoints.
+
+    MAX(id) + COUNT(*) together change on every insert and delete, so
+    hashing them (plus any query args) gives an ETag that lets repeat
+    polls skip the full SELECT and JSON serialization with a 304.
+    """
+    row = conn.execute(SQL[version_sql_key], (line_id,)).fetchone()
+    raw = f'{line_id}:{extra}:{row[0]}:{row[1]}'
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]
+
+
+JWT_ALGORITHM = 'HS256'
+JWT_TTL = timedelta(days=7)
+AUTH_COOKIE = 'auth_token'
+
+
+def issue_token(line_id, name):
+    payload = {
+        'line_id': line_id,
+        'name': name,
+        'exp': datetime.now(timezone.utc) + JWT_TTL,
+    }
+    return jwt.encode(payload, app.secret_key, algorithm=JWT_ALGORITHM)
+
+
+def current_user():
+    """Decode the signed auth cookie once per request; None when absent,
+    expired, or tampered with. Keeps workers stateless — no server-side
+    session storage or itsdangerous session deserialization per request."""
+    token = request.cookies.get(AUTH_COOKIE)
+    if not token:
+        return None
+    try:
+        return jwt.decode(token, app.secret_key, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+
+
+def login_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        user = current_user()
+        if user is None:
+            return jsonify({'error': '請先登入！'}), 401
+        g.user = user
+        return f(*args, **kwargs)
+    return decorated
+
 
 @app.route('/')
 def index():
-    return
+    return render_template('main.html', user=current_user())
+
+
+@app.route('/notebook')
+def notebook():
+    return render_template('notebook.html', user=current_user())
+
+
+@app.route('/login-page')
+def login_page():
+    return render_template('login.html')
+
+
+@app.route('/login')
+def login():
+    params = {
+        'response_type': 'code',
+        'client_id': LINE_CHANNEL_ID,
+        'redirect_uri': LINE_REDIRECT_URI,
+        'state': os.urandom(8).hex(),
+        'scope': 'profile openid',
+    }
+    return redirect(f'{LINE_AUTH_URL}?{urlencode(params)}')
+
+
+@app.route('/callback')
+def callback():
+    code = request.args.get('code')
+    if not code:
+        return redirect('/login-page')
+    try:
+        access_token = get_access_token(code)
+        profile = get_user_profile(access_token)
+    except Exception:
+        return redirect('/login-page')
+
+    line_id = profile['userId']
+    name = profile.get('displayName', '')
+    save_user(line_id, name)
+    response = redirect('/')
+    response.set_cookie(
+        AUTH_COOKIE,
+        issue_token(line_id, name),
+        httponly=True,
+        samesite='Lax',
+        max_age=int(JWT_TTL.total_seconds()),
+    )
+    return response
+
+
+@app.route('/logout')
+def logout():
+    response = redirect('/')
+    response.delete_cookie(AUTH_COOKIE)
+    return response
+
+
+@app.route('/search', methods=['POST'])
+async def search():
+    data = request.get_json(silent=True) or {}
+    query = (data.get('query') or '').strip()
+    if not query:
+        return jsonify({'error': '請輸入搜尋內容！'}), 400
+    # Junk-length queries would still burn an embedding + Pinecone call.
+    # Two CJK characters are a meaningful query, so the ASCII floor is
+    # higher than the general one.
+    if len(query) < 2 or (query.isascii() and len(query) < 3):
+        return jsonify({'error': '搜尋內容太短！'}), 400
+
+    normalized = normalize_query(query)
+    with results_cache_lock:
+        local_hit = results_cache.get(normalized)
+    if local_hit is not None:
+        return orjson_response({'results': local_hit})
+
+    try:
+        query_vector = await asyncio.to_thread(get_embedding, query)
+
+        # The semantic-cache probe and the real query both need the vector,
+        # so overlap them: on a hit the cached set returns without waiting
+        # for formatting, on a miss no extra latency was added.
+        cached_results, matches = await asyncio.gather(
+            asyncio.to_thread(semantic_cache_lookup, query_vector),
+            query_search_index(query_vector),
+        )
+        if cached_results is not None:
+            with results_cache_lock:
+                results_cache[normalized] = cached_results
+            return orjson_response({'results': cached_results})
+
+        with results_cache_lock:
+            results_cache[normalized] = matches
+        await asyncio.to_thread(semantic_cache_store, query, query_vector, matches)
+        return orjson_response({'results': matches})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/messages')
+@login_required
+def get_messages():
+    line_id = g.user['line_id']
+    groups_only = request.args.get('groups_only') == 'true'
+    group_id = request.args.get('group_id')
+
+    try:
+        with pool.acquire() as conn:
+            etag = table_etag(
+                conn, 'messages_version', line_id,
+                extra=f'{groups_only}:{group_id or ""}',
+            )
+            if request.if_none_match.contains(etag):
+                return '', 304
+
+            if groups_only:
+                cursor = conn.execute(SQL['groups'], (line_id,))
+                groups = [
+                    {'group_id': row[0], 'group_name': row[1]}
+                    for row in cursor.fetchall()
+                ]
+                response = jsonify({'groups': groups})
+                response.set_etag(etag)
+                return response
+
+            if group_id:
+                cursor = conn.execute(SQL['messages_by_group'], (line_id, group_id))
+            else:
+                cursor = conn.execute(SQL['messages'], (line_id,))
+            messages = [
+                {
+                    'category': row[0],
+                    'date': row[1],
+                    'event': row[2],
+                    'notes': row[3],
+                    'location': row[4],
+                    'group_id': row[5],
+                    'group_name': row[6],
+                }
+                for row in cursor.fetchall()
+            ]
+        response = jsonify({'messages': messages})
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/pin', methods=['POST'])
+@login_required
+def pin_result():
+    data = request.get_json(silent=True) or {}
+    info = data.get('info')
+    url = data.get('url')
+    if not info or not url:
+        return jsonify({'error': '缺少必要的內容！'}), 400
+
+    try:
+        with pool.acquire() as conn:
+            # The UNIQUE(lineid, info, url) constraint makes the old
+            # SELECT COUNT(*) pre-check redundant: one INSERT OR IGNORE
+            # both checks and inserts in a single round-trip.
+            cursor = conn.execute(SQL['pin_insert'], (g.user['line_id'], info, url))
+            conn.commit()
+            if cursor.rowcount == 0:
+                return jsonify({'message': '已定選過此內容！'})
+        return jsonify({'message': '定選成功！'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def pin_results_bulk(line_id, items):
+    """Insert many pins in one executemany inside a single transaction —
+    N round-trips and N commits collapse to one of each."""
+    rows = [(line_id, item['info'], item['url']) for item in items]
+    with pool.acquire() as conn:
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(SQL['pin_insert'], rows)
+            conn.commit()
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+
+@app.route('/pin_batch', methods=['POST'])
+@login_required
+def pin_batch():
+    data = request.get_json(silent=True) or {}
+    items = data.get('items') or []
+    if not items or not all(item.get('info') and item.get('url') for item in items):
+        return jsonify({'error': '缺少必要的內容！'}), 400
+
+    try:
+        pin_results_bulk(g.user['line_id'], items)
+        return jsonify({'message': '定選成功！', 'count': len(items)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/unpin', methods=['POST'])
+@login_required
+def unpin_result():
+    data = request.get_json(silent=True) or {}
+    info = data.get('info')
+    url = data.get('url')
+    if not info or not url:
+        return jsonify({'error': '缺少必要的內容！'}), 400
+
+    try:
+        with pool.acquire() as conn:
+            conn.execute(SQL['pin_delete'], (g.user['line_id'], info, url))
+            conn.commit()
+        return jsonify({'message': '取消定選成功！'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/get_pinned')
+@login_required
+def get_pinned():
+    try:
+        with pool.acquire() as conn:
+            etag = table_etag(conn, 'pinned_version', g.user['line_id'])
+            if request.if_none_match.contains(etag):
+                return '', 304
+
+            cursor = conn.execute(SQL['pinned_list'], (g.user['line_id'],))
+            pinned = [{'info': row[0], 'url': row[1]} for row in cursor.fetchall()]
+        response = jsonify({'pinned': pinned})
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/check_pinned', methods=['POST'])
+@login_required
+def check_pinned():
+    data = request.get_json(silent=True) or {}
+    info = data.get('info')
+    url = data.get('url')
+    if not info or not url:
+        return jsonify({'error': '缺少必要的內容！'}), 400
+
+    try:
+        with pool.acquire() as conn:
+            cursor = conn.execute(SQL['pin_exists'], (g.user['line_id'], info, url))
+            exists = cursor.fetchone() is not None
+        return jsonify({'exists': exists})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,80 @@
+"""One-shot schema migration for SQLite Cloud.
+
+Run once per deploy (RUN_MIGRATIONS=1 python migrate.py) instead of having
+every worker replay the DDL at boot.
+"""
+
+import os
+
+import sqlitecloud
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SQLITE_CLOUD_URL = os.getenv('SQLITE_CLOUD_URL')
+
+DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS user (
+        lineid TEXT PRIMARY KEY,
+        name TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS user_pinned (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        lineid TEXT NOT NULL,
+        info TEXT NOT NULL,
+        url TEXT NOT NULL,
+        UNIQUE(lineid, info, url)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS linebot_message (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        line_id TEXT NOT NULL,
+        group_id TEXT,
+        group_name TEXT,
+        category TEXT,
+        date TEXT,
+        event TEXT,
+        notes TEXT,
+        location TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS embedding_cache (
+        hash TEXT PRIMARY KEY,
+        vector BLOB NOT NULL
+    )
+    ''',
+    # Hot queries filter by line_id (+ group_id) and lineid; without
+    # these every /api/messages and /get_pinned call full-scans.
+    'CREATE INDEX IF NOT EXISTS idx_msg_user_group '
+    'ON linebot_message(line_id, group_id)',
+    'CREATE INDEX IF NOT EXISTS idx_pinned_user ON user_pinned(lineid)',
+    # Covering partial index: the notebook's groups_only query
+    # (SELECT DISTINCT group_id, group_name ... WHERE group_id IS NOT NULL)
+    # is answered entirely from the index, O(groups) not O(messages).
+    'CREATE INDEX IF NOT EXISTS idx_msg_groups '
+    'ON linebot_message(line_id, group_id, group_name) '
+    'WHERE group_id IS NOT NULL',
+]
+
+
+def migrate():
+    conn = sqlitecloud.connect(SQLITE_CLOUD_URL)
+    try:
+        for statement in DDL:
+            conn.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    if os.getenv('RUN_MIGRATIONS') == '1':
+        migrate()
+        print('migrations applied')
+    else:
+        print('RUN_MIGRATIONS != 1, skipping')